@@ -1,19 +1,40 @@
 import datetime
-import json
 import logging
+import random
+import re
 import sys
-from dataclasses import dataclass
-from time import sleep
-from typing import Any
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from time import monotonic, time
+from typing import Any, Callable, Mapping
+
+import orjson
 
 import requests
 
 DISCORD_API_URL = "https://discord.com/api/v10"
+# Connect and read timeout (in seconds) for Discord API requests
+DEFAULT_TIMEOUT = 10
+# Maximum number of retries when rate limited
+MAX_RETRIES = 5
+# Maximum backoff (in seconds) before retrying a rate limited request when Discord gives no delay
+MAX_RETRY_WAIT = 60
+
+# Discord epoch (in milliseconds) used by snowflake IDs
+DISCORD_EPOCH = 1420070400000
+# Bulk deletion limits: number of messages per request and maximum age (in seconds) of messages
+BULK_DELETE_MAX_MESSAGES = 100
+BULK_DELETE_MAX_AGE = 14 * 86400
+
+# Discord rate limits are shared per "major parameter" (the first channel, guild or webhook ID of a route)
+MAJOR_PARAMETER_REGEX = re.compile(r"^/(?:channels|guilds|webhooks)/\d+")
+MINOR_PARAMETER_REGEX = re.compile(r"/\d+")
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Channel:
     """Discord channel."""
 
@@ -21,63 +42,51 @@ class Channel:
     channel_id: str
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Event:
     """Discord event."""
 
     name: str
-    description: str
+    # Descriptions are not compared, events are matched on their schedule and location
+    description: str = field(compare=False)
     start_time: str
     end_time: str
-    metadata: dict[str, str]
+    # Dicts cannot be hashed, metadata is still compared but left out of the hash
+    metadata: dict[str, str] = field(hash=False)
     privacy_level: int = 2
 
-    def __eq__(self, other) -> bool:
-        if not isinstance(other, Event):
-            # don't attempt to compare against unrelated types
-            return NotImplemented
-
-        return (
-            self.name == other.name
-            and self.start_time == other.start_time
-            and self.end_time == other.end_time
-            and self.metadata == other.metadata
-            and self.privacy_level == other.privacy_level
-        )
+
+@dataclass(slots=True)
+class RateLimitBucket:
+    """Discord rate limit bucket state."""
+
+    limit: int
+    remaining: int
+    # Monotonic deadline at which the bucket resets
+    reset_at: float
+    # Reset timestamp sent by Discord, all the responses of a same window share it
+    window: float
+    # The window is over, the counters are a local guess until Discord reports the next one
+    expired: bool = False
 
 
 class DiscordGuildError(Exception):
     """Base exception class."""
 
 
-def _api_request(
-    url: str,
-    method: str,
-    headers: None | dict = None,
-    data: None | str = None,
-    expected_status: None | int = 200,
-    error_ok: bool = False,
-) -> tuple[int, dict]:
-    """Manage API requests."""
-    response = requests.request(method, url, headers=headers, data=data)
-    logger.debug("API response code: %s", response.status_code)
-    logger.debug("API response content: %s", response.content)
-
-    if response.status_code == 429:
-        if "X-RateLimit-Reset-After" in response.headers:
-            seconds = float(response.headers.get("X-RateLimit-Reset-After", 0))
-            logger.info("Rate limiting hit, waiting for %s seconds", seconds)
-            sleep(seconds)
-            return _api_request(url, method, headers, data, expected_status, error_ok)
+def _route_key(method: str, path: str) -> tuple[str, str]:
+    """Get the rate limit route and major parameter of an API path."""
 
-    if not error_ok:
-        response.raise_for_status()
-        assert response.status_code == expected_status
+    major = ""
+    if match := MAJOR_PARAMETER_REGEX.match(path):
+        major = match.group(0)
+    return f"{method} {major}{MINOR_PARAMETER_REGEX.sub('/{id}', path[len(major):])}", major
 
-    try:
-        return response.status_code, response.json()
-    except requests.exceptions.JSONDecodeError:
-        return response.status_code, {}
+
+def _snowflake_timestamp(snowflake: str) -> int:
+    """Get the creation timestamp (in milliseconds) of a Discord snowflake ID."""
+
+    return (int(snowflake) >> 22) + DISCORD_EPOCH
 
 
 class DiscordGuild:
@@ -85,82 +94,289 @@ class DiscordGuild:
 
     _channels_list_ttl = 3600
     _events_list_ttl = 3600
+    _missing_channels_ttl = 60
 
     def __init__(self, token: str, bot_url: str, guild_id: str) -> None:
         self.base_api_url = DISCORD_API_URL
         self.guild_id = guild_id
-        self.headers = {
-            "Authorization": f"Bot {token}",
-            "User-Agent": f"DiscordBot ({bot_url}) Python/{sys.version_info.major}.{sys.version_info.minor} "
-            f"requests/{requests.__version__}",
-            "Content-Type": "application/json",
-        }
-        self._refresh_events()
-        self._refresh_channels()
-
-    def _refresh_events(self):
+        # Keep connections to the API alive between calls instead of paying a TLS handshake each time
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+        self._session.mount("https://", adapter)
+        self._session.headers.update(
+            {
+                "Authorization": f"Bot {token}",
+                "User-Agent": f"DiscordBot ({bot_url}) Python/{sys.version_info.major}.{sys.version_info.minor} "
+                f"requests/{requests.__version__}",
+            }
+        )
+        # Rate limit state: route -> bucket and bucket -> state
+        # Routes are mapped to themselves until Discord tells their bucket, and to "" if they have none
+        self._routes: dict[str, str] = {}
+        self._buckets: dict[str, RateLimitBucket] = {}
+        # Rate limit state changes are serialized per bucket, other buckets are not held back
+        self._bucket_conditions: dict[str, threading.Condition] = {}
+        # ETags of the last conditional requests by URL
+        self._etags: dict[str, str] = {}
+        # Events list fetches counter and the fetch the current list comes from, older fetches are not applied
+        self._events_fetches = 0
+        self._events_generation = 0
+        self._events_lock = threading.Lock()
+        # Channel name -> deadline until which a missing channel is not looked up again
+        self._missing_channels: dict[str, float] = {}
+        # Serializes channels list refreshes, workers missing the same channel only refresh it once
+        self._channels_lock = threading.RLock()
+        # Both lists come from independent endpoints, fetch them concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            refreshes = [executor.submit(self.refresh_events), executor.submit(self._refresh_channels)]
+            for refresh in refreshes:
+                refresh.result()
+        # Keep both lists fresh in the background so that reading them never waits on the API
+        self._timers: dict[str, threading.Timer] = {}
+        self._closed = False
+        self._schedule_refresh("events", self.refresh_events, self._events_list_ttl)
+        self._schedule_refresh("channels", self._refresh_channels, self._channels_list_ttl)
+
+    def close(self) -> None:
+        """Stop the background refreshes and close the underlying HTTP session."""
+        self._closed = True
+        for timer in self._timers.values():
+            timer.cancel()
+        self._session.close()
+
+    def _schedule_refresh(self, name: str, refresh: Callable[[], None], ttl: float) -> None:
+        """Run a list refresh once its TTL has expired, then schedule the next one."""
+
+        def run() -> None:
+            logger.info("TTL has expired, refreshing %s list", name)
+            try:
+                refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Unable to refresh %s list", name)
+            if not self._closed:
+                self._schedule_refresh(name, refresh, ttl)
+
+        timer = threading.Timer(ttl, run)
+        timer.daemon = True
+        self._timers[name] = timer
+        timer.start()
+
+    def _api_request(
+        self,
+        url: str,
+        method: str,
+        data: None | bytes = None,
+        expected_status: None | int = 200,
+        error_ok: bool = False,
+        timeout: float = DEFAULT_TIMEOUT,
+        conditional: bool = False,
+    ) -> tuple[int, dict]:
+        """Manage API requests.
+
+        Conditional requests send the ETag of the last response for the same URL and return a 304 status with
+        an empty content when the resource did not change.
+        """
+        route, major = _route_key(method, url.removeprefix(self.base_api_url))
+        # Per-request headers, the session already holds the common ones
+        headers = {}
+        # Only requests with a body need a content type
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        if conditional and (etag := self._etags.get(url)) is not None:
+            headers["If-None-Match"] = etag
+        for attempt in range(MAX_RETRIES + 1):
+            self._await_bucket(route)
+            response = self._session.request(method, url, headers=headers or None, data=data, timeout=timeout)
+            self._update_bucket(route, major, response.headers)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("API response %s: %s", response.status_code, response.content)
+
+            if response.status_code != 429 or attempt == MAX_RETRIES:
+                break
+
+            reset_after = response.headers.get("X-RateLimit-Reset-After") or response.headers.get("Retry-After")
+            if reset_after is not None:
+                # Retrying before the delay asked by Discord would only get another 429
+                seconds = float(reset_after)
+            else:
+                # No hint from Discord, back off exponentially with some jitter
+                seconds = min(2**attempt + random.uniform(0, 1), MAX_RETRY_WAIT)
+            logger.info("Rate limiting hit, waiting for %s seconds", seconds)
+            # The retry waits in _await_bucket along with all the other callers of the bucket
+            self._block_bucket(route, seconds)
+
+        if "If-None-Match" in headers and response.status_code == 304:
+            return response.status_code, {}
+
+        if not error_ok:
+            response.raise_for_status()
+            assert response.status_code == expected_status
+
+        if conditional and (etag := response.headers.get("ETag")) is not None:
+            self._etags[url] = etag
+
+        try:
+            return response.status_code, orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            return response.status_code, {}
+
+    def _bucket_condition(self, key: str) -> threading.Condition:
+        """Get the condition guarding the state of a rate limit bucket."""
+
+        return self._bucket_conditions.setdefault(key, threading.Condition())
+
+    def _notify_bucket(self, key: str) -> None:
+        """Wake up the callers waiting on a rate limit bucket."""
+
+        condition = self._bucket_condition(key)
+        with condition:
+            condition.notify_all()
+
+    def _await_bucket(self, route: str) -> None:
+        """Wait for a request slot in the rate limit bucket of a route and reserve it."""
+
+        while key := self._routes.setdefault(route, route):
+            condition = self._bucket_condition(key)
+            with condition:
+                # Unknown routes are probed with a single request, the others wait for its response
+                bucket = self._buckets.setdefault(key, RateLimitBucket(1, 0, 0, 0))
+                now = monotonic()
+                if now >= bucket.reset_at:
+                    # Start the next window, Discord reports its actual reset with the responses
+                    bucket.remaining = bucket.limit
+                    bucket.reset_at = now + DEFAULT_TIMEOUT
+                    bucket.expired = True
+                if bucket.remaining > 0:
+                    # Reserve the slot before releasing the lock so that concurrent callers cannot take it too
+                    bucket.remaining -= 1
+                    return
+                logger.info("Rate limit bucket exhausted, waiting for %s seconds", bucket.reset_at - now)
+                # Bucket updates wake waiters up, the deadline may have moved
+                condition.wait(bucket.reset_at - now)
+
+    def _block_bucket(self, route: str, seconds: float) -> None:
+        """Hold the requests on the rate limit bucket of a route back for some time."""
+
+        # Routes without a known bucket are blocked on their own
+        key = self._routes.get(route) or route
+        condition = self._bucket_condition(key)
+        with condition:
+            bucket = self._buckets.setdefault(key, RateLimitBucket(1, 0, 0, 0))
+            bucket.remaining = 0
+            bucket.reset_at = max(bucket.reset_at, monotonic() + seconds)
+            self._routes[route] = key
+
+    def _update_bucket(self, route: str, major: str, headers: Mapping[str, str]) -> None:
+        """Record the rate limit state returned by Discord for a route, unless a newer state is already known."""
+
+        # Callers waiting for the probe of a route are woken up once its bucket is known
+        probing = self._routes.get(route) == route
+        if (bucket_hash := headers.get("X-RateLimit-Bucket")) is None:
+            if probing:
+                # Discord does not rate limit this route per bucket, stop probing it
+                self._routes[route] = ""
+                self._notify_bucket(route)
+            return
+        key = f"{bucket_hash}:{major}"
+        remaining = int(headers.get("X-RateLimit-Remaining", 1))
+        reset_after = float(headers.get("X-RateLimit-Reset-After", 0))
+        window = float(headers.get("X-RateLimit-Reset", time() + reset_after))
+        condition = self._bucket_condition(key)
+        with condition:
+            bucket = self._buckets.get(key)
+            if bucket is None or window > bucket.window:
+                # Slots reserved since the window expired locally may not have reached Discord yet
+                if bucket is not None and bucket.expired:
+                    remaining = min(remaining, bucket.remaining)
+                limit = int(headers.get("X-RateLimit-Limit", 1))
+                self._buckets[key] = RateLimitBucket(limit, remaining, monotonic() + reset_after, window)
+            elif window == bucket.window and not bucket.expired:
+                # Responses of a same window can arrive out of order, the lowest count is the latest
+                bucket.remaining = min(bucket.remaining, remaining)
+            self._routes[route] = key
+            condition.notify_all()
+        if probing:
+            self._notify_bucket(route)
+
+    def refresh_events(self) -> None:
         """Refresh the list of guild events."""
         url = f"{self.base_api_url}/guilds/{self.guild_id}/scheduled-events"
-        events = []
-        _, response = _api_request(url, "GET", self.headers)
-        for event in response:
-            events.append(
-                Event(
-                    event["name"],
-                    description=event["description"] if event["description"] is not None else "",
-                    start_time=event["scheduled_start_time"],
-                    end_time=event["scheduled_end_time"],
-                    metadata=event["entity_metadata"],
-                )
+        with self._events_lock:
+            self._events_fetches += 1
+            generation = self._events_fetches
+        status, response = self._api_request(url, "GET", conditional=True)
+        # Events often share the same schedule, intern timestamps so they share the same string objects
+        # The end time is optional for voice and stage events
+        events = [
+            Event(
+                event["name"],
+                event["description"] or "",
+                sys.intern(event["scheduled_start_time"]),
+                (end_time := event["scheduled_end_time"]) and sys.intern(end_time),
+                event["entity_metadata"],
             )
-        self._events = events
-        self._events_last_pull = datetime.datetime.now().timestamp()
+            for event in response
+        ]
+        with self._events_lock:
+            # A background refresh started before a later one completed would restore an outdated list
+            if generation < self._events_generation:
+                logger.debug("Events list fetch is outdated, discarding it")
+                return
+            self._events_generation = generation
+            if status == 304:
+                logger.debug("Events list has not changed")
+                return
+            self._events = events
 
     def _refresh_channels(self) -> None:
         """Refresh the list of guild channels."""
 
         url = f"{self.base_api_url}/guilds/{self.guild_id}/channels"
-        channels = []
-        _, response = _api_request(url, "GET", self.headers)
-        for channel in response:
-            channels.append(Channel(channel["name"], channel["id"]))
-        self._channels = channels
-        self._channels_last_pull = datetime.datetime.now().timestamp()
+        with self._channels_lock:
+            _, response = self._api_request(url, "GET")
+            channels = [Channel(sys.intern(channel["name"]), channel["id"]) for channel in response]
+            self._channels = channels
+            # Index channels by name, the first channel wins if several share the same name
+            self._channel_ids = {channel.name: channel.channel_id for channel in reversed(channels)}
+            # Only the channels created since they were looked up are not missing anymore
+            for name in self._missing_channels.keys() & self._channel_ids.keys():
+                del self._missing_channels[name]
 
     @property
     def events(self) -> list[Event]:
         """Returns the list of guild events."""
 
-        if datetime.datetime.now().timestamp() - self._events_last_pull > self._events_list_ttl:
-            logger.info("TTL has expired, refreshing events list")
-            self._refresh_events()
-
         return self._events
 
     @property
     def channels(self) -> list[Channel]:
         """Returns the list of guild channels."""
 
-        if datetime.datetime.now().timestamp() - self._channels_last_pull > self._channels_list_ttl:
-            logger.info("TTL has expired, refreshing channels list")
-            self._refresh_channels()
-
         return self._channels
 
     def get_channel_id(self, name) -> str:
         """Get a channel ID from its name."""
 
-        for channel in self.channels:
-            if channel.name == name:
-                return channel.channel_id
+        if name not in self._channel_ids:
+            with self._channels_lock:
+                # Another worker may have refreshed the list while this one was waiting for the lock
+                if name not in self._channel_ids and monotonic() >= self._missing_channels.get(name, 0):
+                    # The channel may have been created since the last refresh
+                    logger.info("Channel '%s' not found, refreshing channels list", name)
+                    self._refresh_channels()
+                    if name not in self._channel_ids:
+                        self._missing_channels[name] = monotonic() + self._missing_channels_ttl
 
-        raise DiscordGuildError(f"Channel '{name}' not found")
+        try:
+            return self._channel_ids[name]
+        except KeyError:
+            raise DiscordGuildError(f"Channel '{name}' not found") from None
 
-    def create_event(self, event: Event) -> str:
-        """Creates a guild external event."""
+    def create_event(self, event: Event, refresh: bool = True) -> str:
+        """Creates a guild external event, refresh the events list afterward unless told not to."""
 
         url = f"{self.base_api_url}/guilds/{self.guild_id}/scheduled-events"
-        data = json.dumps(
+        data = orjson.dumps(
             {
                 "name": event.name,
                 "privacy_level": event.privacy_level,
@@ -172,27 +388,57 @@ class DiscordGuild:
             }
         )
 
-        _, scheduled_event = _api_request(url, "POST", self.headers, data)
-        self._refresh_events()
+        _, scheduled_event = self._api_request(url, "POST", data)
+        if refresh:
+            self.refresh_events()
         return scheduled_event["id"]
 
-    def create_message(self, channel: str, content: str, mention_everyone: None | bool = False) -> None:
-        """Create a message in a guild channel."""
+    def create_message(self, channel: str, content: str, mention_everyone: None | bool = False) -> str:
+        """Create a message in a guild channel and return its ID."""
 
         url = f"{self.base_api_url}/channels/{self.get_channel_id(channel)}/messages"
         message_data: dict[str, Any]
         message_data = {"content": content}
         if mention_everyone:
             message_data["allowed_mentions"] = {"parse": ["everyone"]}
-        data = json.dumps(message_data)
+        data = orjson.dumps(message_data)
 
-        _api_request(url, "POST", self.headers, data)
+        _, message = self._api_request(url, "POST", data)
+        return message["id"]
 
     def create_invite(self, channel: str, max_age: None | int = 0) -> str:
         """Create a guild invite code."""
 
         url = f"{self.base_api_url}/channels/{self.get_channel_id(channel)}/invites"
-        data = json.dumps({"max_age": max_age})
+        data = orjson.dumps({"max_age": max_age})
 
-        _, invite = _api_request(url, "POST", self.headers, data)
+        _, invite = self._api_request(url, "POST", data)
         return invite["code"]
+
+    def delete_message(self, channel: str, message_id: str) -> None:
+        """Delete a message from a guild channel."""
+
+        url = f"{self.base_api_url}/channels/{self.get_channel_id(channel)}/messages/{message_id}"
+
+        self._api_request(url, "DELETE", expected_status=204)
+
+    def delete_messages(self, channel: str, message_ids: list[str]) -> None:
+        """Delete several messages from a guild channel, in bulk when possible."""
+
+        url = f"{self.base_api_url}/channels/{self.get_channel_id(channel)}/messages/bulk-delete"
+        # Bulk deletion refuses messages older than 2 weeks, keep a margin for clock skew
+        oldest = (datetime.datetime.now().timestamp() - BULK_DELETE_MAX_AGE + 60) * 1000
+        recent = [message_id for message_id in message_ids if _snowflake_timestamp(message_id) > oldest]
+        single = [message_id for message_id in message_ids if _snowflake_timestamp(message_id) <= oldest]
+
+        for start in range(0, len(recent), BULK_DELETE_MAX_MESSAGES):
+            end = start + BULK_DELETE_MAX_MESSAGES
+            chunk = recent[start:end]
+            # Bulk deletion needs at least 2 messages
+            if len(chunk) < 2:
+                single.extend(chunk)
+                continue
+            self._api_request(url, "POST", orjson.dumps({"messages": chunk}), expected_status=204)
+
+        for message_id in single:
+            self.delete_message(channel, message_id)
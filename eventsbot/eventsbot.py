@@ -1,13 +1,16 @@
 import argparse
 import logging
+import operator
 import os
 import pathlib
-import re
+import selectors
 import signal
 import sys
-import time
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
 from enum import Enum, auto
+from functools import partial, reduce
 from typing import Any
 
 import icalendar
@@ -32,12 +35,42 @@ DEFAULT_MESSAGE = "A new event was added"
 
 DISCORD_SHORT_URL = "https://discord.gg"
 
+# Event properties making an event recurring or overriding a recurring event occurrence
+RECURRENCE_PROPERTIES = ("RRULE", "RDATE", "RECURRENCE-ID")
+
+# Maximum number of events created on Discord concurrently
+MAX_WORKERS = 8
+
+# Connect and read timeout (in seconds) for calendar downloads
+CALENDAR_TIMEOUT = 30
+
 ENV_PREFIX = "eventsbot_"
 
+# Mandatory configuration options as paths in the configuration, sections come before their options
+MANDATORY_OPTIONS = (
+    ("calendar_url",),
+    ("discord",),
+    ("discord", "token"),
+    ("discord", "bot_url"),
+    ("discord", "server_id"),
+)
+OPTIONAL_VALUES = {"default_location": DEFAULT_EVENT_LOCATION, "run_interval": DEFAULT_INTERVAL}
+# Environment variables values read as booleans (case insensitive)
+TRUE_VALUES = frozenset({"yes", "true", "on", "1"})
+FALSE_VALUES = frozenset({"no", "false", "off", "0"})
+
 # We cannot access return values from a scheduled function
 # The solution is to use a global variable
 ADDED_EVENTS = 0
 
+# Number of the signal asking the bot to stop, set by the signal handler and checked by the main loop
+STOP: None | int = None
+
+# Parsed calendars by URL, to avoid downloading or parsing unchanged calendars again
+CALENDARS_CACHE: dict[str, "CachedCalendar"] = {}
+# Calendars are downloaded again on every run, keep the connection alive
+SESSION = requests.Session()
+
 logger = logging.getLogger()
 logger.setLevel(logging.WARN)
 handler = logging.StreamHandler()
@@ -46,6 +79,56 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
+@dataclass
+class CachedCalendar:
+    """Parsed calendar along with what is needed to know if it changed."""
+
+    content: bytes
+    calendar: Any
+    etag: None | str = None
+    last_modified: None | str = None
+
+
+class SingleEventsCalendar:
+    """Calendar without any recurring event, filtered without expanding recurrences."""
+
+    def __init__(self, calendar: icalendar.Calendar) -> None:
+        self.events = calendar.walk("VEVENT")
+
+    @staticmethod
+    def _to_datetime(value: date | datetime, tzinfo: Any) -> datetime:
+        """Convert a date or a floating datetime to a timezone aware datetime."""
+        if not isinstance(value, datetime):
+            value = datetime.combine(value, datetime.min.time())
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=tzinfo)
+        return value
+
+    def between(self, start: datetime, end: datetime) -> list[icalendar.Component]:
+        """Get the events happening between two dates, all of them with an end like expanded occurrences."""
+        events = []
+        for event in self.events:
+            event_start = event.decoded("dtstart")
+            if "DTEND" in event:
+                event_end = event.decoded("dtend")
+            else:
+                if "DURATION" in event:
+                    event_end = event_start + event.decoded("duration")
+                elif not isinstance(event_start, datetime):
+                    # All-day events without end last one day (RFC 5545)
+                    event_end = event_start + timedelta(days=1)
+                else:
+                    event_end = event_start
+                event = event.copy()
+                event.add("dtend", event_end)
+            event_start = self._to_datetime(event_start, start.tzinfo)
+            event_end = self._to_datetime(event_end, start.tzinfo)
+            # Events without duration happening right at the start are included too
+            if event_start < end and (event_end > start or event_start >= start):
+                events.append(event)
+        return events
+
+
 class ConfigMode(Enum):
     """Configuration modes."""
 
@@ -53,24 +136,63 @@ class ConfigMode(Enum):
     CLI = auto()
 
 
+def get_calendar(url: str) -> Any:
+    """Get the occurrences of an ICS calendar."""
+    headers = {}
+    if (cached := CALENDARS_CACHE.get(url)) is not None:
+        if cached.etag is not None:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified is not None:
+            headers["If-Modified-Since"] = cached.last_modified
+
+    response = SESSION.get(url, headers=headers, timeout=CALENDAR_TIMEOUT)
+    if cached is not None and response.status_code == 304:
+        logger.debug("Calendar %s has not been modified, using cached version", url)
+        return cached.calendar
+    response.raise_for_status()
+    # The parser accepts bytes, no need to decode the whole calendar to a string first
+    ical_content = response.content
+
+    if cached is not None and cached.content == ical_content:
+        logger.debug("Calendar %s has not changed, using cached version", url)
+        calendar = cached.calendar
+    else:
+        calendar = icalendar.Calendar.from_ical(ical_content)
+        if any(prop in event for event in calendar.walk("VEVENT") for prop in RECURRENCE_PROPERTIES):
+            calendar = recurring_ical_events.of(calendar)
+        else:
+            # Expanding recurrences is costly, skip it when there are none
+            calendar = SingleEventsCalendar(calendar)
+    CALENDARS_CACHE[url] = CachedCalendar(
+        ical_content, calendar, response.headers.get("ETag"), response.headers.get("Last-Modified")
+    )
+    return calendar
+
+
+def _utc_isoformat(value: datetime) -> str:
+    """Format a datetime in UTC as ISO 8601."""
+    if value.tzinfo is not pytz.utc:
+        value = value.astimezone(pytz.utc)
+    return value.isoformat()
+
+
 def get_this_week_events(url: str, default_location: str) -> list[Event]:
     """Get events happening this week from an ICS calendar."""
-    ical_string = requests.get(url).text
-    calendar = icalendar.Calendar.from_ical(ical_string)
+    calendar = get_calendar(url)
 
-    now = pytz.utc.localize(datetime.utcnow())
+    now = datetime.now(pytz.utc)
     start_date = now - timedelta(days=now.weekday())
     end_date = start_date + timedelta(days=6)
 
     events = []
-    for event in recurring_ical_events.of(calendar).between(start_date, end_date):
+    for event in calendar.between(start_date, end_date):
         location = event.decoded("location") if event.decoded("location") else default_location
         events.append(
             Event(
                 event.get("summary"),
                 event.get("description"),
-                event.decoded("dtstart").astimezone(pytz.utc).isoformat(),
-                event.decoded("dtend").astimezone(pytz.utc).isoformat(),
+                _utc_isoformat(event.decoded("dtstart")),
+                _utc_isoformat(event.decoded("dtend")),
                 {"location": location},
             )
         )
@@ -80,29 +202,17 @@ def get_this_week_events(url: str, default_location: str) -> list[Event]:
 def check_config(config: dict, mode: ConfigMode) -> None:
     """Validate the configuration dict."""
 
-    mandatory_options = {"root": ["calendar_url"], "discord": ["token", "bot_url", "server_id"]}
-    for key, options in mandatory_options.items():
-        if key != "root" and key not in config:
+    for path in MANDATORY_OPTIONS:
+        try:
+            reduce(operator.getitem, path, config)
+        except (KeyError, TypeError):
             if mode == ConfigMode.CLI:
-                msg = f"Missing '{key}' in configuration file."
+                msg = f"Missing '{'.'.join(path)}' in configuration file."
             else:
-                msg = f"Missing '{ENV_PREFIX + key}' environment variable."
-            raise KeyError(msg)
-
-        for option in options:
-            search_dict = config
-            if key != "root":
-                search_dict = config[key]
-            if option not in search_dict:
-                if mode == ConfigMode.CLI:
-                    msg = f"Missing '{key}.{option}' in configuration file."
-                else:
-                    msg = f"Missing '{ENV_PREFIX + option}' environment variable."
-                raise KeyError(msg)
-    optional_values = {"default_location": DEFAULT_EVENT_LOCATION, "run_interval": DEFAULT_INTERVAL}
-    for key, value in optional_values.items():
-        if key not in config:
-            config[key] = value
+                msg = f"Missing '{ENV_PREFIX + path[-1]}' environment variable."
+            raise KeyError(msg) from None
+    for key, value in OPTIONAL_VALUES.items():
+        config.setdefault(key, value)
 
 
 def load_config(config_path: pathlib.Path) -> dict:
@@ -133,9 +243,9 @@ def load_config(config_path: pathlib.Path) -> dict:
 
 def signal_handler(sig: int, _) -> None:
     """Handle signal for a clean exit."""
-    logger.info("Recieved signal %s, exiting.", sig)
-    schedule.clear()
-    sys.exit()
+    # Only set a flag, the handler can interrupt the main thread anywhere, even while it holds a lock
+    global STOP  # pylint: disable=global-statement
+    STOP = sig
 
 
 def send_message(guild: DiscordGuild, message: dict, event_id: str) -> None:
@@ -156,6 +266,18 @@ def send_message(guild: DiscordGuild, message: dict, event_id: str) -> None:
     guild.create_message(channel, content, message.get("mention_everyone", False))
 
 
+def add_event(config: dict, guild: DiscordGuild, event: Event) -> None:
+    """Create an event on Discord and announce it if needed."""
+
+    logger.info("Creating new event %s (%s) on Discord.", event.name, event.start_time)
+    # The events list is refreshed once all new events are created
+    event_id = guild.create_event(event, refresh=False)
+
+    message = config["discord"].get("message", {})
+    if message:
+        send_message(guild, message, event_id)
+
+
 def update_events(config: dict, guild: DiscordGuild) -> None:
     """Check upcoming events and create them on Discord if needed."""
 
@@ -175,37 +297,70 @@ def update_events(config: dict, guild: DiscordGuild) -> None:
     for event in events:
         logger.info("\t- %s (%s - %s)", event.name, event.start_time, event.end_time)
 
+    existing_events = set(guild.events)
+    new_events = []
     for event in events:
-        if event in guild.events:
+        if event in existing_events:
             logger.debug("Event %s (%s) already exist, skipping.", event.name, event.start_time)
             continue
-        logger.info("Creating new event %s (%s) on Discord.", event.name, event.start_time)
-        event_id = guild.create_event(event)
-        ADDED_EVENTS += 1
+        existing_events.add(event)
+        new_events.append(event)
 
-        message = config["discord"].get("message", {})
-        if message:
-            send_message(guild, message, event_id)
+    if not new_events:
+        return
+
+    # Each new event costs a few API round trips, process them concurrently
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for _ in executor.map(partial(add_event, config, guild), new_events):
+                ADDED_EVENTS += 1
+    finally:
+        # Refresh once all workers are done, concurrent refreshes could overwrite each other with stale lists
+        guild.refresh_events()
 
 
 def run(config: dict) -> int:
     """Run the main loop."""
+    global STOP  # pylint: disable=global-statement
 
     guild = DiscordGuild(config["discord"]["token"], config["discord"]["bot_url"], config["discord"]["server_id"])
 
-    schedule.every(duration_to_seconds(config["run_interval"])).seconds.do(update_events, config, guild)
-    # Run the job now
-    schedule.run_all()
-
-    if config["once"]:
-        schedule.clear()
-        return ADDED_EVENTS
-
-    for sig in (signal.SIGINT, signal.SIGTERM):
-        signal.signal(sig, signal_handler)
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    try:
+        schedule.every(duration_to_seconds(config["run_interval"])).seconds.do(update_events, config, guild)
+        # Run the job now
+        schedule.run_all()
+
+        if config["once"]:
+            schedule.clear()
+            return ADDED_EVENTS
+
+        STOP = None
+        # Signals write to the wakeup pipe, waiting on it ends the sleep right away
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        selector = selectors.DefaultSelector()
+        selector.register(read_fd, selectors.EVENT_READ)
+        signal.set_wakeup_fd(write_fd)
+        try:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, signal_handler)
+            # Sleep until the next job is due instead of polling, a running job finishes before exiting
+            while STOP is None and (idle_seconds := schedule.idle_seconds()) is not None:
+                if selector.select(max(idle_seconds, 0)):
+                    os.read(read_fd, 512)
+                    continue
+                schedule.run_pending()
+        finally:
+            signal.set_wakeup_fd(-1)
+            selector.close()
+            os.close(read_fd)
+            os.close(write_fd)
+        if STOP is not None:
+            logger.info("Recieved signal %s, exiting.", STOP)
+            schedule.clear()
+    finally:
+        guild.close()
 
     return ADDED_EVENTS
 
@@ -216,13 +371,11 @@ def get_from_env(variable: str, default: None | str = None) -> None | bool | str
     if variable not in os.environ:
         return default
 
-    value = None
-    if variable in os.environ:
-        value = os.environ.get(variable)
-        if value is not None and re.search(r"^[Y|y]es|YES|[T|t]rue|TRUE|[O|o]n|ON|1$", value):
-            return True
-        if value is not None and re.search(r"^[N|n]o|NO|[F|f]alse|FALSE|[O|o]ff|OFF|0$", value):
-            return False
+    value = os.environ[variable]
+    if (lowered := value.strip().lower()) in TRUE_VALUES:
+        return True
+    if lowered in FALSE_VALUES:
+        return False
     return value
 
 